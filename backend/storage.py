@@ -0,0 +1,523 @@
+"""Repositories for users, products, categories and customers.
+
+server.py reaches the catalog, the accounts and the customers through these
+instead of Motor collections. STORAGE_BACKEND picks the implementation:
+"mongo" (default) or "sqlite", an embedded WAL-mode file. Orders and
+everything built on them (change feed, counters, events, rollups, job queue,
+idempotency keys) are Mongo code in server.py, so a MongoDB server is needed
+with either backend. tests/test_storage.py runs the same conformance checks
+against both, and the "storage" benchmark times them.
+
+Documents go in and come out as plain dicts shaped like the API models, never
+with Mongo's _id.
+"""
+
+import asyncio
+import json
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+CUSTOMER_FIELDS = ("id", "name", "phone", "notes", "created_at")
+
+
+def public_customer(customer: dict) -> dict:
+    """A customer without its search keys"""
+    return {field: customer.get(field) for field in CUSTOMER_FIELDS if field in customer}
+
+
+class DuplicateError(Exception):
+    """A unique key (id, username, category name, customer phone) is already taken"""
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    async def get_by_username(self, username: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def insert(self, user: dict): ...
+
+
+class ProductRepository(ABC):
+    @abstractmethod
+    async def list(self, category: Optional[str] = None, limit: int = 500) -> List[dict]: ...
+
+    @abstractmethod
+    async def get(self, product_id: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def insert_many(self, products: List[dict]): ...
+
+    @abstractmethod
+    async def update(self, product_id: str, fields: dict) -> Optional[dict]:
+        """The updated product, or None if there is none with this id"""
+
+    @abstractmethod
+    async def delete(self, product_id: str) -> bool: ...
+
+    @abstractmethod
+    async def count(self, category: Optional[str] = None) -> int: ...
+
+
+class CategoryRepository(ABC):
+    @abstractmethod
+    async def list(self, limit: int = 100) -> List[dict]: ...
+
+    @abstractmethod
+    async def get(self, category_id: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def get_by_name(self, name: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def insert_many(self, categories: List[dict]): ...
+
+    @abstractmethod
+    async def update(self, category_id: str, fields: dict) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def delete(self, category_id: str) -> bool: ...
+
+    @abstractmethod
+    async def count(self) -> int: ...
+
+
+class CustomerRepository(ABC):
+    """Customers carry name_tokens/phone_digits search keys, which are stored
+    but not returned"""
+
+    @abstractmethod
+    async def search(self, text: Optional[str], limit: int = 500) -> List[dict]:
+        """Case-insensitive substring match on name or phone, sorted by name"""
+
+    @abstractmethod
+    async def suggest(self, name_prefixes: List[str], phone_prefix: Optional[str], limit: int) -> List[dict]:
+        """Customers with a name token starting with every prefix (or a phone
+        key starting with phone_prefix), sorted by name"""
+
+    @abstractmethod
+    async def insert(self, customer: dict): ...
+
+    @abstractmethod
+    async def insert_if_absent(self, customer: dict) -> bool:
+        """Insert unless a customer with this phone exists; True if inserted"""
+
+    @abstractmethod
+    async def backfill_search_keys(self, search_keys) -> int:
+        """Add search_keys(name, phone) to customers stored without them"""
+
+
+class Storage:
+    def __init__(self, users: UserRepository, products: ProductRepository, categories: CategoryRepository,
+                 customers: CustomerRepository):
+        self.users = users
+        self.products = products
+        self.categories = categories
+        self.customers = customers
+
+    def close(self):
+        pass
+
+
+def open_storage(backend: str, db=None, sqlite_path: Optional[str] = None) -> Storage:
+    if backend == "mongo":
+        return MongoStorage(db)
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"STORAGE_BACKEND non supportato: {backend}")
+
+
+# ==================== MONGO ====================
+
+class MongoUsers(UserRepository):
+    def __init__(self, db):
+        self.collection = db.users
+
+    async def get_by_username(self, username):
+        return await self.collection.find_one({"username": username}, {"_id": 0})
+
+    async def insert(self, user):
+        try:
+            await self.collection.insert_one(dict(user))
+        except DuplicateKeyError:
+            raise DuplicateError(user["username"])
+
+
+class MongoProducts(ProductRepository):
+    def __init__(self, db):
+        self.collection = db.products
+
+    async def list(self, category=None, limit=500):
+        query = {"category": category} if category else {}
+        return await self.collection.find(query, {"_id": 0}).limit(limit or 0).to_list(limit)
+
+    async def get(self, product_id):
+        return await self.collection.find_one({"id": product_id}, {"_id": 0})
+
+    async def insert_many(self, products):
+        await self.collection.insert_many([dict(product) for product in products])
+
+    async def update(self, product_id, fields):
+        if not fields:
+            return await self.get(product_id)
+        return await self.collection.find_one_and_update(
+            {"id": product_id},
+            {"$set": fields},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def delete(self, product_id):
+        result = await self.collection.delete_one({"id": product_id})
+        return result.deleted_count > 0
+
+    async def count(self, category=None):
+        return await self.collection.count_documents({"category": category} if category else {})
+
+
+class MongoCategories(CategoryRepository):
+    def __init__(self, db):
+        self.collection = db.categories
+
+    async def list(self, limit=100):
+        return await self.collection.find({}, {"_id": 0}).limit(limit or 0).to_list(limit)
+
+    async def get(self, category_id):
+        return await self.collection.find_one({"id": category_id}, {"_id": 0})
+
+    async def get_by_name(self, name):
+        return await self.collection.find_one({"name": name}, {"_id": 0})
+
+    async def insert_many(self, categories):
+        try:
+            await self.collection.insert_many([dict(category) for category in categories])
+        except DuplicateKeyError:
+            raise DuplicateError("name")
+
+    async def update(self, category_id, fields):
+        try:
+            return await self.collection.find_one_and_update(
+                {"id": category_id},
+                {"$set": fields},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            raise DuplicateError(fields.get("name"))
+
+    async def delete(self, category_id):
+        result = await self.collection.delete_one({"id": category_id})
+        return result.deleted_count > 0
+
+    async def count(self):
+        return await self.collection.count_documents({})
+
+
+class MongoCustomers(CustomerRepository):
+    PROJECTION = {"_id": 0, **{field: 1 for field in CUSTOMER_FIELDS}}
+
+    def __init__(self, db):
+        self.collection = db.customers
+
+    async def search(self, text, limit=500):
+        query = {}
+        if text:
+            pattern = re.escape(text)
+            query["$or"] = [
+                {"name": {"$regex": pattern, "$options": "i"}},
+                {"phone": {"$regex": pattern, "$options": "i"}}
+            ]
+        return await self.collection.find(query, self.PROJECTION).sort("name", 1).limit(limit or 0).to_list(limit)
+
+    async def suggest(self, name_prefixes, phone_prefix, limit):
+        # Anchored, case-sensitive regexes on the normalized keys: index range scans
+        if phone_prefix:
+            query = {"phone_digits": {"$regex": f"^{re.escape(phone_prefix)}"}}
+        elif name_prefixes:
+            query = {"$and": [{"name_tokens": {"$regex": f"^{re.escape(prefix)}"}} for prefix in name_prefixes]}
+        else:
+            query = {}
+        return await self.collection.find(query, self.PROJECTION).sort("name", 1).limit(limit or 0).to_list(limit)
+
+    async def insert(self, customer):
+        try:
+            await self.collection.insert_one(dict(customer))
+        except DuplicateKeyError:
+            raise DuplicateError(customer["phone"])
+
+    async def insert_if_absent(self, customer):
+        # Upsert on the unique phone index: one round trip, no race
+        try:
+            result = await self.collection.update_one(
+                {"phone": customer["phone"]},
+                {"$setOnInsert": {key: value for key, value in customer.items() if key != "phone"}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False  # inserted concurrently
+        return result.upserted_id is not None
+
+    async def backfill_search_keys(self, search_keys):
+        missing = self.collection.find({"name_tokens": {"$exists": False}}, {"_id": 1, "name": 1, "phone": 1})
+        updates = [
+            UpdateOne({"_id": customer["_id"]}, {"$set": search_keys(customer.get("name"), customer.get("phone"))})
+            async for customer in missing
+        ]
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False)
+        return len(updates)
+
+
+class MongoStorage(Storage):
+    def __init__(self, db):
+        super().__init__(MongoUsers(db), MongoProducts(db), MongoCategories(db), MongoCustomers(db))
+
+
+# ==================== SQLITE ====================
+
+# Each table keeps the document as JSON plus the fields it is looked up or
+# sorted by as indexed columns. Customer search keys get their own table so a
+# prefix lookup is an index range scan, as with Mongo's multikey indexes.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY, username TEXT NOT NULL UNIQUE, doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY, category TEXT, doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_category ON products (category);
+CREATE TABLE IF NOT EXISTS categories (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL UNIQUE, doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS customers (
+    id TEXT PRIMARY KEY, phone TEXT NOT NULL UNIQUE, name TEXT, doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customers_name ON customers (name);
+CREATE TABLE IF NOT EXISTS customer_keys (
+    kind TEXT NOT NULL, key TEXT NOT NULL, customer_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS customer_keys_lookup ON customer_keys (kind, key, customer_id);
+CREATE INDEX IF NOT EXISTS customer_keys_customer ON customer_keys (customer_id);
+"""
+
+
+def prefix_bounds(prefix: str):
+    """[low, high) range of the strings starting with prefix"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SqliteTable:
+    """One document table: `columns` are copied out of the document on every write"""
+
+    table = ""
+    columns = ()
+
+    def __init__(self, storage: "SqliteStorage"):
+        self.storage = storage
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self.storage.connection
+
+    def row(self, doc: dict) -> tuple:
+        return (doc["id"], *[doc.get(column) for column in self.columns], json.dumps(doc))
+
+    def insert_rows(self, docs: List[dict]):
+        placeholders = ", ".join("?" * (len(self.columns) + 2))
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    f"INSERT INTO {self.table} (id, {', '.join(self.columns)}, doc) VALUES ({placeholders})",
+                    [self.row(doc) for doc in docs]
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(str(e))
+
+    def select(self, where: str = "", params: tuple = (), order: str = "", limit: Optional[int] = None) -> List[dict]:
+        sql = f"SELECT doc FROM {self.table}"
+        if where:
+            sql += f" WHERE {where}"
+        if order:
+            sql += f" ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [json.loads(doc) for (doc,) in self.connection.execute(sql, params)]
+
+    def select_one(self, where: str, params: tuple) -> Optional[dict]:
+        found = self.select(where, params, limit=1)
+        return found[0] if found else None
+
+    def update_row(self, doc_id: str, fields: dict) -> Optional[dict]:
+        try:
+            with self.connection:
+                doc = self.select_one("id = ?", (doc_id,))
+                if doc is None:
+                    return None
+                doc.update(fields)
+                assignments = ", ".join(f"{column} = ?" for column in self.columns)
+                self.connection.execute(
+                    f"UPDATE {self.table} SET {assignments}, doc = ? WHERE id = ?",
+                    (*self.row(doc)[1:], doc_id)
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateError(str(e))
+        return doc
+
+    def delete_row(self, doc_id: str) -> Optional[dict]:
+        with self.connection:
+            doc = self.select_one("id = ?", (doc_id,))
+            if doc is not None:
+                self.connection.execute(f"DELETE FROM {self.table} WHERE id = ?", (doc_id,))
+        return doc
+
+    def count_rows(self, where: str = "", params: tuple = ()) -> int:
+        sql = f"SELECT COUNT(*) FROM {self.table}" + (f" WHERE {where}" if where else "")
+        return self.connection.execute(sql, params).fetchone()[0]
+
+    async def run(self, fn, *args):
+        return await self.storage.run(fn, *args)
+
+
+class SqliteUsers(SqliteTable, UserRepository):
+    table = "users"
+    columns = ("username",)
+
+    async def get_by_username(self, username):
+        return await self.run(self.select_one, "username = ?", (username,))
+
+    async def insert(self, user):
+        await self.run(self.insert_rows, [user])
+
+
+class SqliteProducts(SqliteTable, ProductRepository):
+    table = "products"
+    columns = ("category",)
+
+    async def list(self, category=None, limit=500):
+        if category:
+            return await self.run(self.select, "category = ?", (category,), "rowid", limit)
+        return await self.run(self.select, "", (), "rowid", limit)
+
+    async def get(self, product_id):
+        return await self.run(self.select_one, "id = ?", (product_id,))
+
+    async def insert_many(self, products):
+        await self.run(self.insert_rows, products)
+
+    async def update(self, product_id, fields):
+        return await self.run(self.update_row, product_id, fields)
+
+    async def delete(self, product_id):
+        return await self.run(self.delete_row, product_id) is not None
+
+    async def count(self, category=None):
+        if category:
+            return await self.run(self.count_rows, "category = ?", (category,))
+        return await self.run(self.count_rows)
+
+
+class SqliteCategories(SqliteTable, CategoryRepository):
+    table = "categories"
+    columns = ("name",)
+
+    async def list(self, limit=100):
+        return await self.run(self.select, "", (), "rowid", limit)
+
+    async def get(self, category_id):
+        return await self.run(self.select_one, "id = ?", (category_id,))
+
+    async def get_by_name(self, name):
+        return await self.run(self.select_one, "name = ?", (name,))
+
+    async def insert_many(self, categories):
+        await self.run(self.insert_rows, categories)
+
+    async def update(self, category_id, fields):
+        return await self.run(self.update_row, category_id, fields)
+
+    async def delete(self, category_id):
+        return await self.run(self.delete_row, category_id) is not None
+
+    async def count(self):
+        return await self.run(self.count_rows)
+
+
+class SqliteCustomers(SqliteTable, CustomerRepository):
+    table = "customers"
+    columns = ("phone", "name")
+
+    def insert_keys(self, customers: List[dict]):
+        self.connection.executemany(
+            "INSERT INTO customer_keys (kind, key, customer_id) VALUES (?, ?, ?)",
+            [(kind, key, customer["id"])
+             for customer in customers
+             for kind, field in (("name", "name_tokens"), ("phone", "phone_digits"))
+             for key in customer.get(field) or []]
+        )
+
+    def insert_customer(self, customer: dict, if_absent: bool) -> bool:
+        conflict = " ON CONFLICT (phone) DO NOTHING" if if_absent else ""
+        try:
+            with self.connection:
+                inserted = self.connection.execute(
+                    f"INSERT INTO customers (id, phone, name, doc) VALUES (?, ?, ?, ?){conflict}", self.row(customer)
+                ).rowcount
+                if inserted:
+                    self.insert_keys([customer])
+        except sqlite3.IntegrityError:
+            raise DuplicateError(customer["phone"])
+        return bool(inserted)
+
+    def suggest_rows(self, name_prefixes, phone_prefix, limit):
+        lookups = [("phone", phone_prefix)] if phone_prefix else [("name", prefix) for prefix in name_prefixes]
+        where = " AND ".join(
+            "id IN (SELECT customer_id FROM customer_keys WHERE kind = ? AND key >= ? AND key < ?)" for _ in lookups
+        )
+        params = tuple(value for kind, prefix in lookups for value in (kind, *prefix_bounds(prefix)))
+        return [public_customer(doc) for doc in self.select(where, params, "name", limit)]
+
+    async def search(self, text, limit=500):
+        if not text:
+            rows = await self.run(self.select, "", (), "name", limit)
+        else:
+            pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+            rows = await self.run(self.select, "name LIKE ? ESCAPE '\\' OR phone LIKE ? ESCAPE '\\'",
+                                  (pattern, pattern), "name", limit)
+        return [public_customer(doc) for doc in rows]
+
+    async def suggest(self, name_prefixes, phone_prefix, limit):
+        return await self.run(self.suggest_rows, name_prefixes, phone_prefix, limit)
+
+    async def insert(self, customer):
+        await self.run(self.insert_customer, customer, False)
+
+    async def insert_if_absent(self, customer):
+        return await self.run(self.insert_customer, customer, True)
+
+    async def backfill_search_keys(self, search_keys):
+        return 0  # keys are written with every customer
+
+
+class SqliteStorage(Storage):
+    """One connection, used from a single thread: SQLite serializes writers
+    anyway, and in WAL mode a backup can read the file while the app writes"""
+
+    def __init__(self, path: str):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SQLITE_SCHEMA)
+        super().__init__(SqliteUsers(self), SqliteProducts(self), SqliteCategories(self), SqliteCustomers(self))
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connection.close()
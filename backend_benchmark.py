@@ -0,0 +1,835 @@
+#!/usr/bin/env python3
+"""
+Performance Benchmarks for Macelleria Tumminello Order Management System
+Measures latency of the API under realistic load patterns
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+import uvicorn
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+from pymongo import MongoClient, monitoring
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies):
+    """Latency summary in milliseconds"""
+    ms = [value * 1000 for value in latencies]
+    return {
+        "requests": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 2) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 2) if ms else None,
+        "max_ms": round(max(ms), 2) if ms else None,
+        "mean_ms": round(statistics.mean(ms), 2) if ms else None,
+    }
+
+
+def import_server():
+    """The backend module, for in-process measurements"""
+    # Importing the app only creates the (lazy) Motor client: no database needed
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "benchmark")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import server
+    return server
+
+
+def latency_summaries(results, path=()):
+    """(path, summary) for every latency summary nested in a results dict"""
+    if isinstance(results, dict):
+        if "p95_ms" in results:
+            yield " / ".join(path), results
+            return
+        for key, value in results.items():
+            yield from latency_summaries(value, path + (key,))
+
+
+def compare_results(previous, current):
+    """Print p50/p95/p99 of this run next to a previous results file"""
+    before = dict(latency_summaries(previous))
+    print("\n📊 Compared with previous run")
+    for name, summary in latency_summaries(current):
+        if name not in before:
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            old, new = before[name].get(key), summary.get(key)
+            if old and new is not None:
+                cells.append(f"{key[:3]} {old} → {new} ms ({(new - old) / old * 100:+.0f}%)")
+        print(f"   {name}: " + ", ".join(cells))
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Number and total duration of the Mongo commands a client sends"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.micros = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.count += 1
+        self.micros += event.duration_micros
+
+    def failed(self, event):
+        self.count += 1
+        self.micros += event.duration_micros
+
+
+async def timed_call(client, samples, name, method, url, **kwargs):
+    """One in-process request, its latency recorded under name (errors apart)"""
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    elapsed = time.perf_counter() - start
+    entry = samples.setdefault(name, {"latencies": [], "errors": 0})
+    if response.status_code >= 400:
+        entry["errors"] += 1
+    else:
+        entry["latencies"].append(elapsed)
+    return response
+
+
+class MacelleriaBenchmark:
+    def __init__(self, base_url="http://localhost:8001"):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.token = None
+        self.results = {}
+
+    def url(self, endpoint):
+        return f"{self.base_url}/api/{endpoint}"
+
+    def login(self, username="banco", password="banco123"):
+        response = requests.post(self.url("auth/login"), json={"username": username, "password": password}, timeout=30)
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    def timed_request(self, method, endpoint, token, data=None):
+        start = time.perf_counter()
+        response = self.session.request(method, self.url(endpoint), json=data,
+                                        headers={'Authorization': f'Bearer {token}'}, timeout=30)
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        return elapsed
+
+    def timed_get(self, endpoint, token):
+        return self.timed_request("GET", endpoint, token)
+
+    def sample_order(self, pickup_date=None):
+        pickup_date = pickup_date or (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+        return {
+            "customer_name": "Benchmark Cliente",
+            "customer_phone": "3339999999",
+            "items": [{"product_id": str(uuid.uuid4()), "product_name": "Salsiccia Fresca",
+                       "quantity": 1.5, "unit": "kg", "notes": ""}],
+            "pickup_date": pickup_date,
+            "pickup_time_slot": "10:00-12:00",
+            "notes": "Ordine di benchmark"
+        }
+
+    def poll_for(self, endpoint, token, seconds):
+        """Call an endpoint back to back for a number of seconds"""
+        latencies = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            latencies.append(self.timed_get(endpoint, token))
+        return latencies
+
+    def bench_login_burst(self, seconds=5, burst_logins=40, burst_concurrency=20):
+        """p99 of GET /api/orders alone, then while a burst of logins runs"""
+        print("\n🔐 Benchmark: /api/orders latency during a login burst...")
+        token = self.login()
+
+        baseline = self.poll_for("orders", token, seconds)
+
+        login_latencies = []
+
+        def timed_login(_):
+            start = time.perf_counter()
+            self.login()
+            login_latencies.append(time.perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=burst_concurrency) as pool:
+            burst = pool.map(timed_login, range(burst_logins))
+            during_burst = self.poll_for("orders", token, seconds)
+            list(burst)
+
+        result = {
+            "orders_baseline": summarize(baseline),
+            "orders_during_burst": summarize(during_burst),
+            "logins": summarize(login_latencies),
+        }
+        self.results["login_burst"] = result
+        print(f"   orders p99 baseline: {result['orders_baseline']['p99_ms']} ms, "
+              f"during burst: {result['orders_during_burst']['p99_ms']} ms "
+              f"({burst_logins} logins, p50 {result['logins']['p50_ms']} ms)")
+        return result
+
+    def mongo_commands(self):
+        """Cumulative Mongo command counts and seconds per collection, scraped from /metrics"""
+        headers = {'Authorization': f"Bearer {os.environ['METRICS_TOKEN']}"} if os.environ.get("METRICS_TOKEN") else {}
+        response = self.session.get(f"{self.base_url}/metrics", headers=headers, timeout=30)
+        response.raise_for_status()
+        totals = {}
+        for family in text_string_to_metric_families(response.text):
+            if family.name != "mongo_command_duration_seconds":
+                continue
+            for sample in family.samples:
+                suffix = sample.name[len(family.name):]
+                if suffix in ("_count", "_sum"):
+                    entry = totals.setdefault(sample.labels["collection"], {"_count": 0, "_sum": 0})
+                    entry[suffix] += sample.value
+        return totals
+
+    def measured_writes(self, token, build, iterations):
+        """Latency plus Mongo commands and time per request of a write route"""
+        before = self.mongo_commands()
+        latencies = []
+        for i in range(iterations):
+            method, endpoint, data = build(i)
+            latencies.append(self.timed_request(method, endpoint, token, data))
+        after = self.mongo_commands()
+        per_collection = {
+            collection: round((after[collection]["_count"] - before.get(collection, {}).get("_count", 0)) / iterations, 2)
+            for collection in after
+            if after[collection]["_count"] > before.get(collection, {}).get("_count", 0)
+        }
+        seconds = sum(after[c]["_sum"] - before.get(c, {}).get("_sum", 0) for c in after)
+        return dict(summarize(latencies),
+                    mongo_commands=round(sum(per_collection.values()), 2),
+                    mongo_ms=round(seconds * 1000 / iterations, 3),
+                    mongo_commands_by_collection=per_collection)
+
+    def legacy_writes(self, order, product, iterations):
+        """Mongo commands and time per request of the pre-batching write routes
+        (find_one, update_one, find_one), replayed with a command listener.
+        Needs MONGO_URL/DB_NAME, as for the backend."""
+        counter = CommandCounter()
+        mongo = MongoClient(os.environ["MONGO_URL"], event_listeners=[counter])
+        db = mongo[os.environ["DB_NAME"]]
+        now = datetime.now().isoformat()
+
+        def update_order_notes(i):
+            db.orders.find_one({"id": order["id"]})
+            db.orders.update_one({"id": order["id"]}, {"$set": {"notes": f"nota {i}", "updated_at": now}})
+            db.orders.find_one({"id": order["id"]}, {"_id": 0})
+
+        def update_order_status(i):
+            db.orders.find_one({"id": order["id"]})
+            db.orders.update_one({"id": order["id"]}, {"$set": {"status": ("in_lavorazione", "pronto")[i % 2]}})
+            db.orders.find_one({"id": order["id"]}, {"_id": 0})
+
+        def acknowledge_order(i):
+            db.orders.find_one({"id": order["id"]})
+            db.orders.update_one({"id": order["id"]}, {"$set": {"acknowledged": True, "acknowledged_at": now}})
+
+        def update_product(i):
+            db.products.find_one({"id": product["id"]})
+            db.products.update_one({"id": product["id"]}, {"$set": {"price": float(i)}})
+            db.products.find_one({"id": product["id"]}, {"_id": 0})
+
+        legacy = {
+            "PUT /orders/{id} (note)": update_order_notes,
+            "PATCH /orders/{id}/status": update_order_status,
+            "PATCH /orders/{id}/acknowledge": acknowledge_order,
+            "PUT /products/{id}": update_product,
+        }
+        result = {}
+        try:
+            for name, write in legacy.items():
+                counter.reset()
+                for i in range(iterations):
+                    write(i)
+                result[name] = {"mongo_commands": round(counter.count / iterations, 2),
+                                "mongo_ms": round(counter.micros / 1000 / iterations, 3)}
+        finally:
+            mongo.close()
+        return result
+
+    def bench_write_latency(self, iterations=50, batch=20):
+        """Latency and Mongo commands per request of the order/product/category
+        update routes, against the pre-batching code path (replayed directly on
+        Mongo when MONGO_URL/DB_NAME are set) and, for status and acknowledge,
+        one bulk request against a loop of single-order ones"""
+        print("\n✏️  Benchmark: write route latency and Mongo round trips...")
+        token = self.login()
+        headers = {'Authorization': f'Bearer {token}'}
+        order = self.session.post(self.url("orders"), json=self.sample_order(), headers=headers, timeout=30).json()
+        product = self.session.post(self.url("products"), json={"name": "Benchmark Prodotto", "category": "altro"},
+                                    headers=headers, timeout=30).json()
+        category = self.session.post(self.url("categories"), json={"name": f"bench-{uuid.uuid4().hex[:6]}",
+                                                                    "label": "Benchmark"},
+                                     headers=headers, timeout=30).json()
+        # Two batches of orders: one updated an order per request, the other in one request
+        batch_orders = [
+            self.session.post(self.url("orders"), json=self.sample_order(), headers=headers, timeout=30).json()
+            for _ in range(2 * batch)
+        ]
+        single_ids = [o["id"] for o in batch_orders[:batch]]
+        bulk_ids = [o["id"] for o in batch_orders[batch:]]
+
+        statuses = ["in_lavorazione", "pronto"]
+        writes = {
+            "PUT /orders/{id} (note)": lambda i: ("PUT", f"orders/{order['id']}", {"notes": f"nota {i}"}),
+            "PUT /orders/{id} (prodotti)": lambda i: ("PUT", f"orders/{order['id']}",
+                                                      {"items": [dict(order['items'][0], quantity=1 + i)]}),
+            "PATCH /orders/{id}/status": lambda i: ("PATCH", f"orders/{order['id']}/status",
+                                                    {"status": statuses[i % 2]}),
+            "PATCH /orders/{id}/acknowledge": lambda i: ("PATCH", f"orders/{order['id']}/acknowledge", {}),
+            "PUT /products/{id}": lambda i: ("PUT", f"products/{product['id']}", {"price": float(i)}),
+            "PUT /categories/{id}": lambda i: ("PUT", f"categories/{category['id']}",
+                                               {"name": category['name'], "label": f"Benchmark {i}"}),
+        }
+        bulk = {
+            f"status, {batch} orders": (
+                lambda i: ("PATCH", f"orders/{single_ids[i]}/status", {"status": "in_lavorazione"}),
+                lambda i: ("POST", "orders/status", {"ids": bulk_ids, "status": "in_lavorazione"}),
+            ),
+            f"acknowledge, {batch} orders": (
+                lambda i: ("PATCH", f"orders/{single_ids[i]}/acknowledge", {}),
+                lambda i: ("POST", "orders/acknowledge", {"ids": bulk_ids}),
+            ),
+        }
+        result = {"routes": {}, "bulk": {}}
+        try:
+            for name, build in writes.items():
+                result["routes"][name] = {"after": self.measured_writes(token, build, iterations)}
+            if os.environ.get("MONGO_URL") and os.environ.get("DB_NAME"):
+                for name, before in self.legacy_writes(order, product, iterations).items():
+                    result["routes"][name]["before"] = before
+            else:
+                print("   ⏭️  pre-batching replay skipped: MONGO_URL and DB_NAME are needed")
+            for name, route in result["routes"].items():
+                after, before = route["after"], route.get("before")
+                line = f"   {name}: p50 {after['p50_ms']} ms, {after['mongo_commands']} Mongo commands/request"
+                if before:
+                    line += f" (before: {before['mongo_commands']})"
+                print(line)
+
+            for name, (singles, batched) in bulk.items():
+                result["bulk"][name] = {
+                    "before": self.measured_writes(token, singles, batch),
+                    "after": self.measured_writes(token, batched, 1),
+                }
+            for name, comparison in result["bulk"].items():
+                before, after = comparison["before"], comparison["after"]
+                print(f"   {name}: {batch} requests × {before['mongo_commands']} Mongo commands, "
+                      f"{round(before['mean_ms'] * batch, 2)} ms → "
+                      f"1 request, {after['mongo_commands']} commands, {after['mean_ms']} ms")
+        finally:
+            for o in [order] + batch_orders:
+                self.session.delete(self.url(f"orders/{o['id']}"), headers=headers, timeout=30)
+            self.session.delete(self.url(f"products/{product['id']}"), headers=headers, timeout=30)
+            self.session.delete(self.url(f"categories/{category['id']}"), headers=headers, timeout=30)
+
+        self.results["write_latency"] = result
+        return result
+
+    def bench_analytics(self, orders=100000, iterations=5, batch=10000):
+        """GET /api/analytics/products over a year of synthetic orders.
+
+        The orders are inserted straight into Mongo (MONGO_URL/DB_NAME, as for the
+        backend) with pickup dates in 2001, and removed afterwards.
+        """
+        print(f"\n📈 Benchmark: product analytics over {orders} orders...")
+        if not os.environ.get("MONGO_URL") or not os.environ.get("DB_NAME"):
+            print("   ⏭️  skipped: MONGO_URL and DB_NAME are needed to insert the synthetic orders")
+            self.results["analytics"] = {"skipped": "MONGO_URL/DB_NAME not set"}
+            return self.results["analytics"]
+        token = self.login()
+        mongo = MongoClient(os.environ["MONGO_URL"])
+        db = mongo[os.environ["DB_NAME"]]
+        products = self.session.get(self.url("products"), headers={'Authorization': f'Bearer {token}'},
+                                    timeout=30).json()
+        if not products:
+            raise RuntimeError("No products: run /api/seed first")
+
+        rng = random.Random(2001)
+        start = datetime(2001, 1, 1)
+        try:
+            for offset in range(0, orders, batch):
+                db.orders.insert_many([
+                    {
+                        "id": str(uuid.uuid4()),
+                        "order_number": f"B{offset + i}/2001",
+                        "customer_name": "Benchmark Cliente",
+                        "customer_phone": "3339999999",
+                        "items": [{"product_id": product["id"], "product_name": product["name"],
+                                   "quantity": rng.choice([0.5, 1, 1.5, 2, 3]), "unit": product.get("unit", "kg"),
+                                   "notes": ""}
+                                  for product in rng.sample(products, min(3, len(products)))],
+                        "pickup_date": (start + timedelta(days=rng.randrange(365))).strftime("%Y-%m-%d"),
+                        "pickup_time_slot": "10:00-12:00",
+                        "status": "ritirato",
+                        "notes": "",
+                        "created_at": start.isoformat(),
+                        "benchmark_analytics": True
+                    }
+                    for i in range(min(batch, orders - offset))
+                ])
+
+            latencies = [
+                self.timed_get("analytics/products?from=2001-01-01&to=2001-12-31&freq=week", token)
+                for _ in range(iterations)
+            ]
+        finally:
+            db.orders.delete_many({"benchmark_analytics": True})
+            db.daily_rollups.delete_many({"date": {"$gte": "2001-01-01", "$lte": "2001-12-31"}})
+            mongo.close()
+
+        result = {"orders": orders, "analytics": summarize(latencies)}
+        self.results["analytics"] = result
+        print(f"   {orders} orders: p50 {result['analytics']['p50_ms']} ms, max {result['analytics']['max_ms']} ms")
+        return result
+
+    def bench_json_serialization(self, orders=1000, iterations=50):
+        """In-process CPU cost of serializing a 1000-order list: the response_model
+        path (Pydantic validation + json) against the ORDERS_FAST_JSON path"""
+        print(f"\n🧾 Benchmark: serialization of {orders} orders...")
+        server = import_server()
+        from fastapi.responses import JSONResponse
+        from fastapi.routing import serialize_response
+
+        server.ORDERS_FAST_JSON = True
+        route = next(route for route in server.app.routes
+                     if getattr(route, "path", None) == "/api/orders" and "GET" in route.methods)
+        rng = random.Random(16)
+        docs = [
+            {
+                **self.sample_order(),
+                "id": str(uuid.uuid4()),
+                "order_number": f"{i + 1}/2024",
+                "items": [{"product_id": str(uuid.uuid4()), "product_name": "Salsiccia Fresca",
+                           "quantity": rng.choice([1, 1.5, 2]), "unit": "kg", "notes": "",
+                           "is_new": True, "added_at": "2024-12-23T10:00:00+00:00"} for _ in range(3)],
+                "status": "nuovo",
+                "created_at": "2024-12-23T09:00:00+00:00",
+                "created_by": "banco",
+                "updated_at": None,
+                "modification_count": 1,
+                "last_modified_at": "2024-12-23T10:00:00+00:00",
+                "last_modified_by": "banco",
+                "acknowledged": True,
+            }
+            for i in range(orders)
+        ]
+
+        async def pydantic_body():
+            content = await serialize_response(field=route.response_field, response_content=docs, is_coroutine=True)
+            return JSONResponse(content).body
+
+        def fast_body():
+            return server.order_list_response(docs, list(server.ORDER_FIELD_DEFAULTS)).body
+
+        timings = {"response_model": [], "fast_json": []}
+
+        async def measure():
+            for _ in range(iterations):
+                start = time.perf_counter()
+                await pydantic_body()
+                timings["response_model"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                fast_body()
+                timings["fast_json"].append(time.perf_counter() - start)
+            return await pydantic_body() == fast_body()
+
+        same_output = asyncio.run(measure())
+
+        result = {name: summarize(latencies) for name, latencies in timings.items()}
+        result["same_output"] = same_output
+        self.results["json_serialization"] = result
+        print(f"   response_model p50 {result['response_model']['p50_ms']} ms, "
+              f"fast_json p50 {result['fast_json']['p50_ms']} ms, identical output: {same_output}")
+        return result
+
+    def bench_compression(self, iterations=20):
+        """Bytes on the wire for the order and customer lists per encoding, and the
+        server CPU time to compress them at the configured levels"""
+        print("\n🗜️  Benchmark: response compression...")
+        server = import_server()
+        token = self.login()
+        encodings = ["identity", "gzip"] + (["br"] if server.brotli else [])
+
+        result = {}
+        for endpoint in ("orders", "customers"):
+            wire = {}
+            body = b""
+            for encoding in encodings:
+                response = self.session.get(self.url(endpoint), stream=True, timeout=30,
+                                            headers={'Authorization': f'Bearer {token}', 'Accept-Encoding': encoding})
+                response.raise_for_status()
+                raw = response.raw.read(decode_content=False)
+                wire[encoding] = len(raw)
+                if encoding == "identity":
+                    body = raw
+            cpu = {}
+            for encoding in encodings[1:]:
+                latencies = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    server.compress_body(body, encoding)
+                    latencies.append(time.perf_counter() - start)
+                cpu[encoding] = summarize(latencies)
+            result[endpoint] = {"bytes": wire, "compress_cpu": cpu}
+            print(f"   /{endpoint}: " + ", ".join(f"{encoding} {size} B" for encoding, size in wire.items()) +
+                  "; CPU p50 " + ", ".join(f"{encoding} {cpu[encoding]['p50_ms']} ms" for encoding in cpu))
+
+        self.results["compression"] = result
+        return result
+
+    def bench_holiday_rush(self, seconds=60, clerks=4, tablets=6, storico=2, burst_every=15, burst_logins=20,
+                           ack_every=5.0):
+        """Christmas-eve mix against the app in-process (httpx ASGITransport, one
+        event loop like a single uvicorn worker) and the MONGO_URL/DB_NAME mongod.
+
+        Banco clerks look up customers, create and edit orders; lab tablets keep
+        /lab/snapshot current from the order event stream, and one of them
+        acknowledges and advances new orders every ack_every seconds; Storico
+        users page through date ranges and daily summaries; every burst_every
+        seconds the whole shift logs in at once. Orders created here are deleted
+        afterwards.
+
+        ASGITransport hands back a response only once it is complete, so the
+        event streams go through a uvicorn server on a local port, started in the
+        same event loop.
+        """
+        print(f"\n🎄 Benchmark: holiday rush for {seconds}s ({clerks} clerks, {tablets} tablets, {storico} storico)...")
+        server = import_server()
+        samples = {}
+        created = []
+        stream_stats = {"events": 0, "reconnects": 0}
+        rng = random.Random(24)
+        today = datetime.now()
+        pickup_dates = [(today + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in (1, 2, 3)]
+        history_from = (today - timedelta(days=30)).strftime("%Y-%m-%d")
+
+        async def clerk(client, headers, products, deadline):
+            while time.perf_counter() < deadline:
+                await timed_call(client, samples, "GET /customers/suggest", "GET", "/api/customers/suggest",
+                                 params={"q": rng.choice(["mar", "ros", "333", "giu", "bia"])}, headers=headers)
+                order = dict(self.sample_order(rng.choice(pickup_dates)),
+                             customer_name=f"Cliente {rng.randrange(500)}",
+                             customer_phone=f"333{rng.randrange(10 ** 7):07d}",
+                             items=[{"product_id": product["id"], "product_name": product["name"],
+                                     "quantity": rng.choice([0.5, 1, 1.5, 2]), "unit": product.get("unit", "kg"),
+                                     "notes": ""} for product in rng.sample(products, 3)])
+                response = await timed_call(client, samples, "POST /orders", "POST", "/api/orders",
+                                            json=order, headers=headers)
+                if response.status_code < 400:
+                    created.append(response.json()["id"])
+                    if rng.random() < 0.3:
+                        await timed_call(client, samples, "PUT /orders/{id}", "PUT", f"/api/orders/{created[-1]}",
+                                         json={"notes": "Aggiunta al banco"}, headers=headers)
+                await asyncio.sleep(rng.uniform(0.5, 2.0))
+
+        async def tablet(index, client, stream_client, headers, deadline):
+            """LaboratorioPage: one snapshot, then the event stream; each burst of
+            events is followed 200 ms later by a conditional snapshot (the browser
+            sends If-None-Match on its own)"""
+            etag = None
+            last_ack = time.perf_counter()
+            changed = asyncio.Event()
+
+            async def fetch_snapshot():
+                nonlocal etag, last_ack
+                response = await timed_call(client, samples, "GET /lab/snapshot", "GET", "/api/lab/snapshot",
+                                            headers=dict(headers, **({"If-None-Match": etag} if etag else {})))
+                if response.status_code != 200:
+                    return
+                etag = response.headers.get("etag")
+                ids = [order["id"] for order in response.json()["unacknowledged"]]
+                if index == 0 and ids and time.perf_counter() - last_ack >= ack_every:
+                    last_ack = time.perf_counter()
+                    await timed_call(client, samples, "POST /orders/acknowledge", "POST",
+                                     "/api/orders/acknowledge", json={"ids": ids}, headers=headers)
+                    await timed_call(client, samples, "PATCH /orders/{id}/status", "PATCH",
+                                     f"/api/orders/{rng.choice(ids)}/status",
+                                     json={"status": "in_lavorazione"}, headers=headers)
+
+            async def listen():
+                # A fresh ticket for every connection, resuming from the last event seen
+                last_event_id = None
+                while True:
+                    response = await timed_call(client, samples, "POST /orders/events/ticket", "POST",
+                                                "/api/orders/events/ticket", headers=headers)
+                    params = {"ticket": response.json()["ticket"]}
+                    if last_event_id:
+                        params["since"] = last_event_id
+                    try:
+                        async with stream_client.stream("GET", "/api/orders/events", params=params) as stream:
+                            event_type = None
+                            async for line in stream.aiter_lines():
+                                if line.startswith("id: "):
+                                    last_event_id = line[4:]
+                                elif line.startswith("event: "):
+                                    event_type = line[7:]
+                                elif not line and event_type:
+                                    if event_type != "ready":
+                                        stream_stats["events"] += 1
+                                        changed.set()
+                                    event_type = None
+                    except httpx.HTTPError:
+                        pass
+                    stream_stats["reconnects"] += 1
+                    await asyncio.sleep(3)
+
+            await fetch_snapshot()
+            listener = asyncio.create_task(listen())
+            try:
+                while time.perf_counter() < deadline:
+                    try:
+                        await asyncio.wait_for(changed.wait(), deadline - time.perf_counter())
+                    except asyncio.TimeoutError:
+                        break
+                    await asyncio.sleep(0.2)
+                    changed.clear()
+                    await fetch_snapshot()
+            finally:
+                listener.cancel()
+                await asyncio.gather(listener, return_exceptions=True)
+
+        async def storico_user(client, headers, deadline):
+            while time.perf_counter() < deadline:
+                params = {"from_date": history_from, "to_date": pickup_dates[-1], "limit": 200}
+                for _ in range(5):
+                    response = await timed_call(client, samples, "GET /orders (intervallo)", "GET", "/api/orders",
+                                                params=params, headers=headers)
+                    next_cursor = response.headers.get("x-next-cursor")
+                    if not next_cursor:
+                        break
+                    params = dict(params, after=next_cursor)
+                await timed_call(client, samples, "GET /history/daily", "GET", "/api/history/daily",
+                                 params={"from": history_from, "to": pickup_dates[-1]}, headers=headers)
+                await asyncio.sleep(rng.uniform(2.0, 5.0))
+
+        async def login_bursts(client, deadline):
+            while time.perf_counter() + burst_every < deadline:
+                await asyncio.sleep(burst_every)
+                await asyncio.gather(*[
+                    timed_call(client, samples, "POST /auth/login", "POST", "/api/auth/login",
+                               json={"username": "banco", "password": "banco123"})
+                    for _ in range(burst_logins)
+                ])
+
+        async def login(client, username, password):
+            response = await client.post("/api/auth/login", json={"username": username, "password": password})
+            response.raise_for_status()
+            return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        async def rush():
+            try:
+                await asyncio.wait_for(server.client.admin.command("ping"), 5)
+            except Exception as e:
+                return {"skipped": f"mongod not reachable at {os.environ['MONGO_URL']}: {e}"}
+            await server.startup_db_client()
+            stream_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=0, lifespan="off",
+                                                          log_level="warning"))
+            serving = asyncio.create_task(stream_server.serve())
+            stream_client = None
+            try:
+                while not stream_server.started:
+                    await asyncio.sleep(0.05)
+                stream_port = stream_server.servers[0].sockets[0].getsockname()[1]
+                stream_client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{stream_port}",
+                                                  timeout=httpx.Timeout(60, read=None))
+                transport = httpx.ASGITransport(app=server.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+                    await client.post("/api/seed")
+                    banco = await login(client, "banco", "banco123")
+                    laboratorio = await login(client, "laboratorio", "lab123")
+                    products = (await client.get("/api/products", headers=banco)).json()
+                    start = time.perf_counter()
+                    deadline = start + seconds
+                    try:
+                        await asyncio.gather(
+                            *[clerk(client, banco, products, deadline) for _ in range(clerks)],
+                            *[tablet(index, client, stream_client, laboratorio, deadline)
+                              for index in range(tablets)],
+                            *[storico_user(client, banco, deadline) for _ in range(storico)],
+                            login_bursts(client, deadline),
+                        )
+                        elapsed = time.perf_counter() - start
+                    finally:
+                        for order_id in created:
+                            await client.delete(f"/api/orders/{order_id}", headers=banco)
+            finally:
+                if stream_client is not None:
+                    await stream_client.aclose()
+                stream_server.should_exit = True
+                await serving
+                # Workers, recovery sweep and nightly rollups: nothing may outlive the loop
+                await server.stop_background_tasks()
+            return {"seconds": round(elapsed, 1), "orders_created": len(created), **stream_stats}
+
+        result = asyncio.run(rush())
+        if "skipped" in result:
+            print(f"   ⏭️  skipped: {result['skipped']}")
+            self.results["holiday_rush"] = result
+            return result
+
+        print(f"   event stream: {result['events']} events received, {result['reconnects']} reconnects")
+        total = sum(len(entry["latencies"]) + entry["errors"] for entry in samples.values())
+        result["throughput_rps"] = round(total / result["seconds"], 1)
+        result["endpoints"] = {}
+        for name, entry in sorted(samples.items()):
+            summary = summarize(entry["latencies"])
+            summary["errors"] = entry["errors"]
+            summary["rps"] = round((len(entry["latencies"]) + entry["errors"]) / result["seconds"], 2)
+            result["endpoints"][name] = summary
+            print(f"   {name}: {summary['rps']} req/s, p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, "
+                  f"p99 {summary['p99_ms']} ms, errors {summary['errors']}")
+        print(f"   total: {total} requests, {result['throughput_rps']} req/s")
+        self.results["holiday_rush"] = result
+        return result
+
+    def bench_storage(self, products=2000, customers=500, iterations=200):
+        """The storage repositories on their own, without HTTP: the same operations
+        against SQLite (temporary file) and, if MONGO_URL is reachable, Mongo
+        (throwaway database)"""
+        print(f"\n🗄️  Benchmark: storage backends ({products} products, {customers} customers)...")
+        import_server()
+        import tempfile
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from storage import open_storage
+
+        rng = random.Random(23)
+        words = ["mario", "maria", "rossi", "bianchi", "russo", "ferrara", "esposito", "romano", "greco", "bruno"]
+        categories = ["bovino", "suino", "pollame", "salumi", "preparati", "altro"]
+
+        async def measure(storage):
+            timings = {}
+
+            async def timed(name, call):
+                start = time.perf_counter()
+                value = await call
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+                return value
+
+            for i in range(customers):
+                first, last = rng.sample(words, 2)
+                phone = f"333{i:07d}"
+                await timed("customers.insert_if_absent", storage.customers.insert_if_absent({
+                    "id": str(uuid.uuid4()), "name": f"{first.title()} {last.title()}", "phone": phone, "notes": "",
+                    "created_at": "2024-12-01T08:00:00", "name_tokens": sorted({first, last}), "phone_digits": [phone]
+                }))
+            ids = [str(uuid.uuid4()) for _ in range(products)]
+            await timed("products.insert_many", storage.products.insert_many([
+                {"id": product_id, "name": f"Prodotto {i}", "category": rng.choice(categories), "unit": "kg",
+                 "description": "", "price": None}
+                for i, product_id in enumerate(ids)
+            ]))
+            for _ in range(iterations):
+                await timed("products.get", storage.products.get(rng.choice(ids)))
+                await timed("products.list (categoria)", storage.products.list(rng.choice(categories)))
+                await timed("products.update", storage.products.update(rng.choice(ids), {"price": 12.5}))
+                await timed("customers.suggest", storage.customers.suggest(rng.sample(words, 1), None, 10))
+                await timed("customers.search", storage.customers.search(rng.choice(words)))
+            return {name: summarize(latencies) for name, latencies in timings.items()}
+
+        async def run_sqlite():
+            with tempfile.TemporaryDirectory() as directory:
+                storage = open_storage("sqlite", sqlite_path=os.path.join(directory, "benchmark.db"))
+                try:
+                    return await measure(storage)
+                finally:
+                    storage.close()
+
+        async def run_mongo():
+            client = AsyncIOMotorClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=3000)
+            name = f"storage_benchmark_{uuid.uuid4().hex[:8]}"
+            try:
+                await client.admin.command("ping")
+            except Exception as e:
+                return {"skipped": f"mongod not reachable: {str(e).split(',')[0]}"}
+            db = client[name]
+            try:
+                await db.customers.create_index("phone", unique=True)
+                await db.customers.create_index([("name_tokens", 1), ("name", 1)])
+                await db.products.create_index("id", unique=True)
+                await db.products.create_index("category")
+                return await measure(open_storage("mongo", db=db))
+            finally:
+                await client.drop_database(name)
+                client.close()
+
+        result = {"sqlite": asyncio.run(run_sqlite()), "mongo": asyncio.run(run_mongo())}
+        for backend, timings in result.items():
+            if "skipped" in timings:
+                print(f"   {backend}: ⏭️  skipped ({timings['skipped']})")
+                continue
+            for name, summary in timings.items():
+                print(f"   {backend} {name}: p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms")
+        self.results["storage"] = result
+        return result
+
+    def run_all(self, scenarios=None):
+        available = {
+            "login_burst": self.bench_login_burst,
+            "write_latency": self.bench_write_latency,
+            "analytics": self.bench_analytics,
+            "json_serialization": self.bench_json_serialization,
+            "compression": self.bench_compression,
+            "holiday_rush": self.bench_holiday_rush,
+            "storage": self.bench_storage,
+        }
+        print("⏱️  Starting Macelleria Tumminello API Benchmarks")
+        print("=" * 50)
+        for name, bench in available.items():
+            if scenarios and name not in scenarios:
+                continue
+            try:
+                bench()
+            except Exception as e:
+                print(f"❌ {name} - Exception: {str(e)}")
+                self.results[name] = {"error": str(e)}
+        return self.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--scenario", action="append", help="Run only this scenario (repeatable)")
+    parser.add_argument("--output", default="backend_benchmark_results.json")
+    parser.add_argument("--compare", help="Results file of a previous run to compare latencies against")
+    args = parser.parse_args()
+
+    benchmark = MacelleriaBenchmark(args.base_url)
+    results = benchmark.run_all(args.scenario)
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f)["results"], results)
+
+    with open(args.output, 'w') as f:
+        json.dump({"timestamp": datetime.now().isoformat(), "base_url": args.base_url, "results": results}, f, indent=2)
+
+    return 1 if any("error" in r for r in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
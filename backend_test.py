@@ -9,6 +9,9 @@ import sys
 import json
 from datetime import datetime, timedelta
 import uuid
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 class MacelleriaAPITester:
     def __init__(self, base_url="https://meatsystem.preview.emergentagent.com"):
@@ -164,6 +167,22 @@ class MacelleriaAPITester:
         
         self.log_test("Products List Validation", True, f"Found {len(products)} products")
 
+        # Test catalog revalidation with the ETag
+        try:
+            response = requests.get(f"{self.base_url}/api/products", headers={'Accept-Encoding': 'identity'},
+                                    timeout=10)
+            etag = response.headers.get('ETag')
+            # Weak: the same tag is served for the identity, gzip and br bodies
+            self.log_test("Products ETag", bool(etag) and etag.startswith('W/'), f"ETag: {etag}")
+            vary = response.headers.get('Vary', '')
+            self.log_test("Products Vary", 'accept-encoding' in vary.lower(), f"Vary: {vary}")
+            if etag:
+                revalidated = requests.get(f"{self.base_url}/api/products", headers={'If-None-Match': etag}, timeout=10)
+                self.log_test("Products Not Modified", revalidated.status_code == 304,
+                              f"Status: {revalidated.status_code}")
+        except Exception as e:
+            self.log_test("Products ETag", False, f"Exception: {str(e)}")
+
         # Test category filtering
         bovino_products = self.run_test(
             "Get Bovino Products",
@@ -259,6 +278,31 @@ class MacelleriaAPITester:
         if search_result is not None:
             self.log_test("Customer Search", True, f"Search returned {len(search_result)} results")
 
+        # Test prefix autocomplete on name and phone
+        for query in ["test cust", "123456", "+39 123456"]:
+            suggestions = self.run_test(
+                f"Suggest Customers '{query}'",
+                "GET",
+                f"customers/suggest?q={quote(query)}",
+                200,
+                token=self.banco_token
+            )
+            if suggestions is not None:
+                found = any(c.get('phone') == new_customer['phone'] for c in suggestions)
+                self.log_test(f"Suggestion Match '{query}'", found, f"{len(suggestions)} suggestions")
+
+        on_focus = self.run_test("Suggest Customers (empty)", "GET", "customers/suggest?q=", 200,
+                                 token=self.banco_token)
+        if on_focus is not None:
+            names = [c.get('name', '') for c in on_focus]
+            self.log_test("Suggest Empty Query", bool(names) and names == sorted(names),
+                          f"{len(names)} suggestions")
+
+        too_short = self.run_test("Suggest Customers (1 char)", "GET", "customers/suggest?q=t", 200,
+                                  token=self.banco_token)
+        if too_short is not None:
+            self.log_test("Suggest Minimum Length", too_short == [], f"{len(too_short)} suggestions")
+
         return True
 
     def test_orders_api(self):
@@ -358,6 +402,372 @@ class MacelleriaAPITester:
             self.log_test("Order Creation", False, "Failed to create order")
             return None
 
+    def test_order_fields(self, order_id):
+        """Test sparse fieldsets and the order history"""
+        print("\n🪶 Testing Order Fields and History...")
+
+        if not self.banco_token or not order_id:
+            self.log_test("Order Fields", False, "No banco token or order available")
+            return False
+
+        orders = self.run_test("Get Orders", "GET", "orders", 200, token=self.banco_token)
+        if orders:
+            self.log_test("Orders Without Modifications Array",
+                          all('modifications' not in order and 'modification_count' in order for order in orders),
+                          f"{len(orders)} orders")
+
+        sparse = self.run_test("Get Orders (Sparse Fields)", "GET", "orders?fields=customer_name,status", 200,
+                               token=self.banco_token)
+        if sparse:
+            self.log_test("Orders Sparse Fields",
+                          all(set(order) == {'id', 'customer_name', 'status'} for order in sparse),
+                          f"keys: {sorted(sparse[0])}")
+
+        self.run_test("Get Orders (Unknown Field)", "GET", "orders?fields=password", 400, token=self.banco_token)
+
+        history = self.run_test("Get Order History", "GET", f"orders/{order_id}/history", 200, token=self.banco_token)
+        if history is not None:
+            # test_orders_api moved this order to in_lavorazione
+            status_events = [e for e in history.get('events', []) if e.get('type') == 'stato']
+            self.log_test("Order History Records Status Changes",
+                          history.get('order_id') == order_id and len(status_events) > 0,
+                          f"{len(history.get('events', []))} events")
+        return True
+
+    def test_orders_pagination(self):
+        """Test keyset pagination and NDJSON streaming of the orders list"""
+        print("\n📄 Testing Orders Pagination...")
+
+        if not self.banco_token:
+            self.log_test("Orders Pagination", False, "No banco token available")
+            return False
+
+        headers = {'Authorization': f'Bearer {self.banco_token}'}
+        try:
+            full = requests.get(f"{self.base_url}/api/orders", headers=headers, timeout=30).json()
+            paged, after, pages = [], None, 0
+            while pages < 100:
+                params = {'limit': 5}
+                if after:
+                    params['after'] = after
+                response = requests.get(f"{self.base_url}/api/orders", params=params, headers=headers, timeout=10)
+                paged += response.json()
+                pages += 1
+                after = response.headers.get('X-Next-Cursor')
+                if not after:
+                    break
+            self.log_test("Paged Orders Match Full List",
+                          [o['id'] for o in paged] == [o['id'] for o in full],
+                          f"{len(paged)} orders in {pages} pages, {len(full)} in full list")
+
+            stream = requests.get(f"{self.base_url}/api/orders/stream", headers=headers, timeout=30)
+            streamed = [json.loads(line) for line in stream.text.splitlines() if line]
+            self.log_test("Streamed Orders Count", len(streamed) >= len(full),
+                          f"{len(streamed)} streamed, Content-Type: {stream.headers.get('Content-Type')}")
+        except Exception as e:
+            self.log_test("Orders Pagination", False, f"Exception: {str(e)}")
+            return False
+
+        return True
+
+    def test_order_number_concurrency(self, concurrent_orders=10):
+        """Create orders in parallel and check every order number is unique"""
+        print("\n🔢 Testing Concurrent Order Numbers...")
+
+        if not self.banco_token:
+            self.log_test("Concurrent Order Numbers", False, "No banco token available")
+            return False
+
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+        order = {
+            "customer_name": "Test Concorrenza",
+            "customer_phone": "3330000000",
+            "items": [{"product_id": str(uuid.uuid4()), "product_name": "Salsiccia Fresca",
+                       "quantity": 1, "unit": "kg", "notes": ""}],
+            "pickup_date": tomorrow,
+            "pickup_time_slot": "mattina",
+            "notes": "Test numerazione concorrente"
+        }
+        url = f"{self.base_url}/api/orders"
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.banco_token}'}
+
+        def create(_):
+            return requests.post(url, json=order, headers=headers, timeout=30)
+
+        with ThreadPoolExecutor(max_workers=concurrent_orders) as pool:
+            responses = list(pool.map(create, range(concurrent_orders)))
+
+        created = [r.json() for r in responses if r.status_code == 200]
+        numbers = [o['order_number'] for o in created]
+        self.log_test("Concurrent Orders Created", len(created) == concurrent_orders,
+                      f"{len(created)}/{concurrent_orders} created")
+        self.log_test("Order Numbers Unique", len(set(numbers)) == len(numbers),
+                      f"Numbers: {sorted(numbers)}")
+
+        for o in created:
+            requests.delete(f"{url}/{o['id']}", headers=headers, timeout=10)
+        return len(set(numbers)) == len(numbers)
+
+    def test_bulk_order_routes(self):
+        """Test bulk acknowledge and bulk status transitions"""
+        print("\n📦 Testing Bulk Order Routes...")
+
+        if not self.banco_token or not self.laboratorio_token:
+            self.log_test("Bulk Order Routes", False, "Missing tokens")
+            return False
+
+        order_data = {
+            "customer_name": "Test Bulk",
+            "customer_phone": "3331112222",
+            "items": [{"product_id": "test", "product_name": "Salsiccia", "quantity": 1, "unit": "kg", "notes": ""}],
+            "pickup_date": (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d"),
+            "pickup_time_slot": "10:00-12:00"
+        }
+        ids = []
+        for _ in range(3):
+            order = self.run_test("Create Order (Bulk)", "POST", "orders", 200, data=order_data, token=self.banco_token)
+            if order:
+                ids.append(order['id'])
+
+        ack = self.run_test("Bulk Acknowledge", "POST", "orders/acknowledge", 200,
+                            data={"ids": ids + ["missing-order"]}, token=self.laboratorio_token)
+        if ack:
+            results = {r['order_id']: r['result'] for r in ack['results']}
+            self.log_test("Bulk Acknowledge Results",
+                          all(results.get(i) == "acknowledged" for i in ids) and results.get("missing-order") == "not_found",
+                          f"{results}")
+        again = self.run_test("Bulk Acknowledge (Repeat)", "POST", "orders/acknowledge", 200,
+                              data={"ids": ids}, token=self.laboratorio_token)
+        if again:
+            self.log_test("Bulk Acknowledge Idempotent", again.get('modified') == 0, f"modified={again.get('modified')}")
+        self.run_test("Bulk Acknowledge (No Selection)", "POST", "orders/acknowledge", 400,
+                      data={}, token=self.laboratorio_token)
+
+        moved = self.run_test("Bulk Status Update", "POST", "orders/status", 200,
+                              data={"ids": ids, "status": "in_lavorazione"}, token=self.laboratorio_token)
+        if moved:
+            self.log_test("Bulk Status Modified", moved.get('modified') == len(ids), f"modified={moved.get('modified')}")
+
+        self.run_test("Bulk Status (Invalid)", "POST", "orders/status", 400,
+                      data={"ids": ids, "status": "sconosciuto"}, token=self.laboratorio_token)
+        self.run_test("Bulk Status (No Selection)", "POST", "orders/status", 400,
+                      data={"status": "pronto"}, token=self.laboratorio_token)
+
+        for order_id in ids:
+            self.run_test("Delete Order (Bulk)", "DELETE", f"orders/{order_id}", 200, token=self.banco_token)
+        return True
+
+    def test_production_cutlist(self):
+        """Test the per-day cut list aggregation and its invalidation"""
+        print("\n🔪 Testing Production Cut List...")
+
+        if not self.banco_token or not self.laboratorio_token:
+            self.log_test("Production Cut List", False, "Missing tokens")
+            return False
+
+        pickup_date = (datetime.now() + timedelta(days=300)).strftime("%Y-%m-%d")
+        product_id = f"cutlist-{uuid.uuid4().hex[:8]}"
+        order_data = {
+            "customer_name": "Test Cut List",
+            "customer_phone": "3334445555",
+            "items": [{"product_id": product_id, "product_name": "Salsiccia", "quantity": 1.5, "unit": "kg", "notes": ""}],
+            "pickup_date": pickup_date,
+            "pickup_time_slot": "10:00-12:00"
+        }
+
+        def product_quantity(cutlist):
+            for category in (cutlist or {}).get('categories', []):
+                for product in category['products']:
+                    if product['product_id'] == product_id:
+                        return product['quantity']
+            return 0
+
+        first = self.run_test("Create Order (Cut List)", "POST", "orders", 200, data=order_data, token=self.banco_token)
+        cutlist = self.run_test("Get Cut List", "GET", f"production/cutlist?date={pickup_date}", 200,
+                                token=self.laboratorio_token)
+        self.log_test("Cut List Quantity", product_quantity(cutlist) == 1.5, f"quantity={product_quantity(cutlist)}")
+
+        second = self.run_test("Create Order (Cut List 2)", "POST", "orders", 200, data=order_data, token=self.banco_token)
+        cutlist = self.run_test("Get Cut List (After Write)", "GET", f"production/cutlist?date={pickup_date}", 200,
+                                token=self.laboratorio_token)
+        self.log_test("Cut List Invalidated", product_quantity(cutlist) == 3.0, f"quantity={product_quantity(cutlist)}")
+
+        for order in (first, second):
+            if order:
+                self.run_test("Delete Order (Cut List)", "DELETE", f"orders/{order['id']}", 200, token=self.banco_token)
+        return True
+
+    def test_history_daily(self):
+        """Test daily rollups and the history range endpoint"""
+        print("\n🗓️  Testing Daily History...")
+
+        if not self.banco_token:
+            self.log_test("Daily History", False, "No banco token available")
+            return False
+
+        to_date = datetime.now().strftime("%Y-%m-%d")
+        from_date = (datetime.now() - timedelta(days=6)).strftime("%Y-%m-%d")
+
+        rollup = self.run_test("Run Daily Rollups", "POST", f"history/rollup?from={from_date}&to={to_date}", 200,
+                               token=self.banco_token)
+        if rollup is not None:
+            self.log_test("Daily Rollups Computed", 'computed' in rollup, f"computed={rollup.get('computed')}")
+
+        days = self.run_test("Get Daily History", "GET", f"history/daily?from={from_date}&to={to_date}", 200,
+                             token=self.banco_token)
+        if days is not None:
+            expected_fields = ['date', 'orders', 'by_status', 'products', 'slots', 'top_customers']
+            self.log_test("Daily History Days", len(days) == 7 and all(all(f in day for f in expected_fields) for day in days),
+                          f"{len(days)} days")
+
+        self.run_test("Get Daily History (Reversed Range)", "GET", f"history/daily?from={to_date}&to={from_date}", 400,
+                      token=self.banco_token)
+        return True
+
+    def test_product_analytics(self):
+        """Test the per-product sales analytics"""
+        print("\n📈 Testing Product Analytics...")
+
+        if not self.banco_token:
+            self.log_test("Product Analytics", False, "No banco token available")
+            return False
+
+        to_date = datetime.now().strftime("%Y-%m-%d")
+        from_date = (datetime.now() - timedelta(days=56)).strftime("%Y-%m-%d")
+        analytics = self.run_test("Get Product Analytics", "GET",
+                                  f"analytics/products?from={from_date}&to={to_date}&freq=week", 200,
+                                  token=self.banco_token)
+        if analytics is not None:
+            periods = analytics.get('periods', [])
+            series_ok = all(len(product['series']) == len(periods) for product in analytics.get('products', []))
+            self.log_test("Product Analytics Series", bool(periods) and series_ok,
+                          f"{len(periods)} periods, {len(analytics.get('products', []))} products")
+
+        self.run_test("Get Product Analytics (Invalid Freq)", "GET",
+                      f"analytics/products?from={from_date}&to={to_date}&freq=year", 400,
+                      token=self.banco_token)
+        return True
+
+    def test_compression(self):
+        """Test negotiated response compression"""
+        print("\n🗜️  Testing Response Compression...")
+
+        if not self.banco_token:
+            self.log_test("Response Compression", False, "No banco token available")
+            return False
+
+        headers = {'Authorization': f'Bearer {self.banco_token}'}
+        try:
+            plain = requests.get(f"{self.base_url}/api/products", headers={**headers, 'Accept-Encoding': 'identity'}, timeout=30)
+            gzipped = requests.get(f"{self.base_url}/api/products", headers={**headers, 'Accept-Encoding': 'gzip'}, timeout=30)
+            self.log_test("Identity Not Compressed", 'Content-Encoding' not in plain.headers,
+                          f"Content-Encoding: {plain.headers.get('Content-Encoding')}")
+            large = len(plain.content) >= 1024
+            self.log_test("Gzip Negotiated",
+                          (gzipped.headers.get('Content-Encoding') == 'gzip') == large and gzipped.json() == plain.json(),
+                          f"{len(plain.content)} bytes, Content-Encoding: {gzipped.headers.get('Content-Encoding')}")
+        except Exception as e:
+            self.log_test("Response Compression", False, f"Exception: {str(e)}")
+            return False
+        return True
+
+    def test_metrics(self):
+        """Test Prometheus metrics exposition"""
+        print("\n📈 Testing Metrics...")
+
+        try:
+            response = requests.get(f"{self.base_url}/metrics", timeout=30)
+            if response.status_code == 401:
+                self.log_test("Metrics Endpoint", True, "Protected by METRICS_TOKEN")
+                return True
+            body = response.text
+            self.log_test("Metrics Endpoint", response.status_code == 200 and response.headers.get('Content-Type', '').startswith('text/plain'),
+                          f"Status: {response.status_code}")
+            self.log_test("Route Templates Labelled", 'route="/api/orders/{order_id}"' in body or 'route="/api/products"' in body,
+                          "http_requests_total by route template")
+            self.log_test("Mongo Command Metrics", 'mongo_command_duration_seconds_bucket{' in body,
+                          "mongo_command_duration_seconds present")
+            self.log_test("Password Pool Gauges", 'password_hash_queue_depth' in body, "password_hash_* present")
+            self.log_test("Job Queue Gauges", 'job_queue_lag_seconds' in body, "job_queue_* present")
+        except Exception as e:
+            self.log_test("Metrics Endpoint", False, f"Exception: {str(e)}")
+            return False
+        return True
+
+    def test_background_jobs(self):
+        """Test the customer upsert queued after order creation"""
+        print("\n📬 Testing Background Jobs...")
+
+        if not self.banco_token:
+            self.log_test("Background Jobs", False, "No banco token available")
+            return False
+
+        phone = f"399{uuid.uuid4().int % 10 ** 7:07d}"
+        order = self.run_test("Create Order (Queued Customer)", "POST", "orders", 200, data={
+            "customer_name": "Cliente Coda",
+            "customer_phone": phone,
+            "items": [{"product_id": "test", "product_name": "Test", "quantity": 1, "unit": "kg", "notes": ""}],
+            "pickup_date": (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d"),
+            "pickup_time_slot": "10:00-12:00",
+            "notes": ""
+        }, token=self.banco_token)
+        if not order:
+            return False
+
+        found = []
+        for _ in range(10):
+            response = requests.get(f"{self.base_url}/api/customers", params={"search": phone}, timeout=30)
+            found = response.json() if response.status_code == 200 else []
+            if found:
+                break
+            time.sleep(0.5)
+        self.log_test("Customer Saved By Job", len(found) == 1, f"{len(found)} customers with phone {phone}")
+
+        runtime = self.run_test("Get Runtime Stats", "GET", "admin/runtime", 200, token=self.banco_token)
+        if runtime is not None:
+            jobs = runtime.get('jobs', {})
+            self.log_test("Job Queue Stats", all(key in jobs for key in ('depth', 'lag_seconds', 'pending_orders')),
+                          f"Jobs: {jobs}")
+        self.run_test("Delete Queued Order", "DELETE", f"orders/{order['id']}", 200, token=self.banco_token)
+        return True
+
+    def test_idempotency_keys(self):
+        """Test that a retried order creation with the same Idempotency-Key is not repeated"""
+        print("\n🔁 Testing Idempotency Keys...")
+
+        if not self.banco_token:
+            self.log_test("Idempotency Keys", False, "No banco token available")
+            return False
+
+        url = f"{self.base_url}/api/orders"
+        headers = {'Authorization': f'Bearer {self.banco_token}', 'Idempotency-Key': str(uuid.uuid4())}
+        order = {
+            "customer_name": "Cliente Idempotente",
+            "customer_phone": "3330009999",
+            "items": [{"product_id": "test", "product_name": "Test", "quantity": 1, "unit": "kg", "notes": ""}],
+            "pickup_date": (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d"),
+            "pickup_time_slot": "10:00-12:00",
+            "notes": ""
+        }
+        try:
+            first = requests.post(url, json=order, headers=headers, timeout=10)
+            retry = requests.post(url, json=order, headers=headers, timeout=10)
+            changed = requests.post(url, json={**order, "notes": "diverso"}, headers=headers, timeout=10)
+        except Exception as e:
+            self.log_test("Idempotency Keys", False, f"Error: {str(e)}")
+            return False
+
+        same = (first.status_code == 200 and retry.status_code == 200
+                and first.json().get('id') == retry.json().get('id'))
+        self.log_test("Retry Returns Stored Order", same and retry.headers.get('Idempotent-Replayed') == 'true',
+                      f"Status: {first.status_code}/{retry.status_code}")
+        self.log_test("Key Reused With Different Body", changed.status_code == 422,
+                      f"Status: {changed.status_code}")
+        if first.status_code == 200:
+            self.run_test("Delete Idempotent Order", "DELETE", f"orders/{first.json()['id']}", 200,
+                          token=self.banco_token)
+        return same
+
     def test_dashboard_api(self):
         """Test dashboard endpoints"""
         print("\n📊 Testing Dashboard API...")
@@ -392,6 +802,173 @@ class MacelleriaAPITester:
         if new_count and 'count' in new_count:
             self.log_test("New Orders Count", True, f"New orders: {new_count['count']}")
 
+        # Live counters must match a recount of the orders
+        reconcile = self.run_test(
+            "Reconcile Order Stats",
+            "POST",
+            "admin/order-stats/reconcile",
+            200,
+            token=self.laboratorio_token
+        )
+        if reconcile is not None and reconcile.get('retry'):
+            # Nothing is recounted until the last order write has settled (ORDER_CHANGES_OVERLAP, 5 s)
+            time.sleep(6)
+            reconcile = self.run_test("Reconcile Order Stats (Settled)", "POST", "admin/order-stats/reconcile", 200,
+                                      token=self.laboratorio_token)
+        if reconcile is not None:
+            self.log_test("Order Stats Without Drift",
+                          not reconcile.get('drift') and not reconcile.get('totals_drift'),
+                          f"drift={reconcile.get('drift')}, totals_drift={reconcile.get('totals_drift')}")
+
+        return True
+
+    def test_order_changes_api(self):
+        """Test delta sync of orders since a cursor"""
+        print("\n🔄 Testing Order Changes (Delta Sync)...")
+
+        if not self.banco_token:
+            self.log_test("Order Changes API", False, "No banco token available")
+            return False
+
+        full = self.run_test(
+            "Get Order Changes (Full)",
+            "GET",
+            "orders/changes",
+            200,
+            token=self.banco_token
+        )
+        if not full or 'cursor' not in full:
+            self.log_test("Order Changes Cursor", False, "No cursor in response")
+            return False
+        self.log_test("Order Changes Reset Flag", full.get('reset') is True, f"reset={full.get('reset')}")
+
+        cursor = full['cursor']
+        while full and full.get('has_more'):
+            cursor = full['cursor']
+            full = self.run_test("Get Order Changes (Page)", "GET", f"orders/changes?since={cursor}", 200, token=self.banco_token)
+        cursor = full['cursor'] if full else cursor
+
+        delta = self.run_test(
+            "Get Order Changes (Delta)",
+            "GET",
+            f"orders/changes?since={cursor}",
+            200,
+            token=self.banco_token
+        )
+        if delta is not None:
+            # Changes from the last few seconds are re-sent (overlap window), but
+            # with nothing new the cursor must not move
+            self.log_test("Order Changes Cursor Unchanged", delta.get('cursor') == cursor and not delta.get('has_more'),
+                          f"{len(delta.get('orders', []))} orders, {len(delta.get('deleted', []))} deleted re-sent")
+
+        self.run_test(
+            "Get Order Changes (Invalid Cursor)",
+            "GET",
+            "orders/changes?since=not-a-cursor",
+            400,
+            token=self.banco_token
+        )
+        return True
+
+    def test_order_events_api(self):
+        """Test the Server-Sent Events stream of order changes"""
+        print("\n📡 Testing Order Events Stream...")
+
+        if not self.laboratorio_token:
+            self.log_test("Order Events Stream", False, "No laboratorio token available")
+            return False
+
+        ticket = self.run_test("Get Order Events Ticket", "POST", "orders/events/ticket", 200,
+                               token=self.laboratorio_token)
+        if not ticket:
+            return False
+        self.run_test("Ticket Rejected As Session Token", "GET", "orders", 401, token=ticket['ticket'])
+        try:
+            response = requests.get(f"{self.base_url}/api/orders/events?token={self.laboratorio_token}", timeout=10)
+            self.log_test("Order Events Rejects Session Token In URL", response.status_code == 401,
+                          f"Status: {response.status_code}")
+        except Exception as e:
+            self.log_test("Order Events Rejects Session Token In URL", False, f"Exception: {str(e)}")
+
+        url = f"{self.base_url}/api/orders/events?ticket={ticket['ticket']}"
+        try:
+            with requests.get(url, stream=True, timeout=10) as response:
+                content_type = response.headers.get('Content-Type', '')
+                self.log_test(
+                    "Order Events Content Type",
+                    response.status_code == 200 and content_type.startswith('text/event-stream'),
+                    f"Status: {response.status_code}, Content-Type: {content_type}"
+                )
+                ready_event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('event: '):
+                        ready_event = line[len('event: '):]
+                        break
+                self.log_test("Order Events Ready", ready_event == 'ready', f"First event: {ready_event}")
+        except Exception as e:
+            self.log_test("Order Events Stream", False, f"Exception: {str(e)}")
+            return False
+
+        self.run_test(
+            "Order Events Without Token",
+            "GET",
+            "orders/events",
+            401
+        )
+        return True
+
+    def test_lab_snapshot_api(self):
+        """Test the combined lab snapshot and its ETag revalidation"""
+        print("\n🧊 Testing Lab Snapshot...")
+
+        if not self.laboratorio_token:
+            self.log_test("Lab Snapshot", False, "No laboratorio token available")
+            return False
+
+        url = f"{self.base_url}/api/lab/snapshot"
+        headers = {'Authorization': f'Bearer {self.laboratorio_token}'}
+        try:
+            response = requests.get(url, headers=headers, timeout=10)
+            snapshot = response.json() if response.status_code == 200 else {}
+            expected_keys = ['orders', 'new_orders', 'unacknowledged', 'stats']
+            self.log_test("Lab Snapshot Structure", all(key in snapshot for key in expected_keys),
+                          f"Status: {response.status_code}, keys: {list(snapshot.keys())}")
+
+            etag = response.headers.get('ETag')
+            if not etag:
+                # No validator until the last order write has settled (ORDER_CHANGES_OVERLAP, 5 s)
+                time.sleep(6)
+                etag = requests.get(url, headers=headers, timeout=10).headers.get('ETag')
+            self.log_test("Lab Snapshot ETag", bool(etag), f"ETag: {etag}")
+            if etag:
+                revalidated = requests.get(url, headers={**headers, 'If-None-Match': etag}, timeout=10)
+                self.log_test("Lab Snapshot Not Modified", revalidated.status_code == 304,
+                              f"Status: {revalidated.status_code}")
+        except Exception as e:
+            self.log_test("Lab Snapshot", False, f"Exception: {str(e)}")
+            return False
+
+        return True
+
+    def test_query_plans(self):
+        """Test that no hot query shape falls back to a collection scan"""
+        print("\n🗂️  Testing Query Plans...")
+
+        if not self.banco_token:
+            self.log_test("Query Plans", False, "No banco token available")
+            return False
+
+        result = self.run_test(
+            "Get Query Plans",
+            "GET",
+            "admin/query-plans",
+            200,
+            token=self.banco_token
+        )
+        if result is not None:
+            collscans = result.get('collscans', [])
+            self.log_test("No Collection Scans", len(collscans) == 0,
+                          f"COLLSCAN: {collscans}" if collscans else f"{len(result.get('plans', []))} queries checked")
         return True
 
     def test_api_root(self):
@@ -426,7 +1003,22 @@ class MacelleriaAPITester:
         self.test_products_api()
         self.test_customers_api()
         order_id = self.test_orders_api()
+        self.test_order_fields(order_id)
+        self.test_orders_pagination()
+        self.test_order_number_concurrency()
+        self.test_bulk_order_routes()
+        self.test_production_cutlist()
+        self.test_history_daily()
+        self.test_product_analytics()
+        self.test_compression()
+        self.test_metrics()
+        self.test_background_jobs()
+        self.test_idempotency_keys()
         self.test_dashboard_api()
+        self.test_order_changes_api()
+        self.test_order_events_api()
+        self.test_lab_snapshot_api()
+        self.test_query_plans()
         
         # Print summary
         print("\n" + "=" * 50)
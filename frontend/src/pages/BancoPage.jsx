@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useNavigate } from "react-router-dom";
 import axios from "axios";
 import { API, useAuth } from "../App";
@@ -33,9 +33,11 @@ const BancoPage = () => {
   
   // Customer state
   const [customerName, setCustomerName] = useState("");
+  // Resubmitting the same order after a failure reuses its key, so an order
+  // that reached the server before the error is not created twice
+  const pendingSubmission = useRef(null);
   const [customerPhone, setCustomerPhone] = useState("");
   const [customers, setCustomers] = useState([]);
-  const [allCustomers, setAllCustomers] = useState([]);
   const [customerSearch, setCustomerSearch] = useState("");
   const [showCustomerDropdown, setShowCustomerDropdown] = useState(false);
   const [selectedCustomer, setSelectedCustomer] = useState(null);
@@ -70,21 +72,14 @@ const BancoPage = () => {
   useEffect(() => {
     fetchProducts();
     fetchTodayOrders();
-    fetchAllCustomers();
     fetchCategories();
   }, []);
 
+  // Suggerimenti clienti dal server (ricerca per prefisso su nome o telefono)
   useEffect(() => {
-    if (customerSearch.length >= 2) {
-      const filtered = allCustomers.filter(c => 
-        c.name.toLowerCase().includes(customerSearch.toLowerCase()) ||
-        c.phone.includes(customerSearch)
-      );
-      setCustomers(filtered);
-    } else {
-      setCustomers(allCustomers.slice(0, 10));
-    }
-  }, [customerSearch, allCustomers]);
+    const timeout = setTimeout(() => fetchCustomerSuggestions(customerSearch), 150);
+    return () => clearTimeout(timeout);
+  }, [customerSearch]);
 
   const fetchCategories = async () => {
     try {
@@ -122,11 +117,10 @@ const BancoPage = () => {
     }
   };
 
-  const fetchAllCustomers = async () => {
+  const fetchCustomerSuggestions = async (query = "") => {
     try {
-      const response = await axios.get(`${API}/customers`, { headers });
-      setAllCustomers(response.data);
-      setCustomers(response.data.slice(0, 10));
+      const response = await axios.get(`${API}/customers/suggest`, { headers, params: { q: query } });
+      setCustomers(response.data);
     } catch (error) {
       console.error("Error fetching customers:", error);
     }
@@ -225,11 +219,19 @@ const BancoPage = () => {
         notes: orderNotes
       };
 
-      await axios.post(`${API}/orders`, orderData, { headers });
+      const body = JSON.stringify(orderData);
+      if (pendingSubmission.current?.body !== body) {
+        pendingSubmission.current = { body, key: crypto.randomUUID() };
+      }
+
+      await axios.post(`${API}/orders`, orderData, {
+        headers: { ...headers, "Idempotency-Key": pendingSubmission.current.key }
+      });
+      pendingSubmission.current = null;
       toast.success("Ordine creato con successo!");
       clearOrder();
       fetchTodayOrders();
-      fetchAllCustomers(); // Refresh customers in case new one was added
+      fetchCustomerSuggestions(customerSearch); // Refresh customers in case new one was added
     } catch (error) {
       toast.error("Errore nella creazione dell'ordine");
     } finally {
@@ -67,14 +67,12 @@ const LaboratorioPage = () => {
   const previousNewCount = useRef(0);
   const headers = { Authorization: `Bearer ${token}` };
 
-  const fetchOrders = useCallback(async () => {
+  // Un'unica richiesta per ordini attivi, nuovi, non confermati e statistiche.
+  // Il server risponde 304 (servito dalla cache del browser) se nulla è cambiato.
+  const fetchSnapshot = useCallback(async () => {
     try {
-      // Carica tutti gli ordini attivi (non completati/consegnati)
-      const response = await axios.get(`${API}/orders`, { headers });
-      // Filtra escludendo ritirato e consegnato
-      const activeOrders = response.data.filter(order => 
-        order.status !== 'ritirato' && order.status !== 'consegnato'
-      );
+      const response = await axios.get(`${API}/lab/snapshot`, { headers });
+      const { orders: activeOrders, new_orders, unacknowledged, stats } = response.data;
       
       // Applica filtro stato se selezionato
       let filteredOrders = activeOrders;
@@ -91,38 +89,32 @@ const LaboratorioPage = () => {
       });
       
       setOrders(filteredOrders);
-    } catch (error) {
-      toast.error("Errore nel caricamento ordini");
-    } finally {
-      setLoading(false);
-    }
-  }, [statusFilter, token]);
-
-  const fetchNewOrders = useCallback(async () => {
-    try {
-      const response = await axios.get(`${API}/orders?status=nuovo`, { headers });
-      setNewOrders(response.data);
-    } catch (error) {
-      console.error("Error fetching new orders:", error);
-    }
-  }, [token]);
-
-  // Fetch unacknowledged orders for pop-up
-  const fetchUnacknowledgedOrders = useCallback(async () => {
-    try {
-      const response = await axios.get(`${API}/orders/unacknowledged`, { headers });
-      const orders = response.data;
-      setUnacknowledgedOrders(orders);
+      setNewOrders(new_orders);
+      setStats(stats);
+      setUnacknowledgedOrders(unacknowledged);
       
       // Show pop-up if there are unacknowledged orders
-      if (orders.length > 0) {
+      if (unacknowledged.length > 0) {
         setShowNewOrdersPopup(true);
         playNotificationSound();
       }
+      
+      // Check for new orders
+      const newCount = stats.new_orders_count;
+      if (newCount > previousNewCount.current) {
+        playNotificationSound();
+        toast.info(`${newCount - previousNewCount.current} nuovo/i ordine/i!`, {
+          icon: <Bell className="w-5 h-5 text-[#5D1919]" />
+        });
+      }
+      previousNewCount.current = newCount;
+      setNewOrdersCount(newCount);
     } catch (error) {
-      console.error("Error fetching unacknowledged orders:", error);
+      toast.error("Errore nel caricamento ordini");
+    } finally {
+      setLoading(false);
     }
-  }, [token]);
+  }, [statusFilter, token]);
 
   // Acknowledge an order
   const acknowledgeOrder = async (orderId) => {
@@ -139,68 +131,78 @@ const LaboratorioPage = () => {
   const acknowledgeAllAndClose = async () => {
     const unackedOrders = unacknowledgedOrders.filter(o => !acknowledgedIds.has(o.id));
     
-    for (const order of unackedOrders) {
+    if (unackedOrders.length > 0) {
       try {
-        await axios.patch(`${API}/orders/${order.id}/acknowledge`, {}, { headers });
+        // Una sola richiesta per tutti gli ordini
+        await axios.post(`${API}/orders/acknowledge`, { ids: unackedOrders.map(o => o.id) }, { headers });
       } catch (error) {
-        console.error("Error acknowledging order:", error);
+        console.error("Error acknowledging orders:", error);
       }
     }
     
     setShowNewOrdersPopup(false);
     setAcknowledgedIds(new Set());
-    fetchUnacknowledgedOrders();
-    fetchOrders();
-    fetchNewOrders();
+    fetchSnapshot();
     toast.success("Tutti gli ordini confermati!");
   };
 
-  const fetchStats = useCallback(async () => {
-    try {
-      const response = await axios.get(`${API}/dashboard/stats`, { headers });
-      setStats(response.data);
-      
-      // Check for new orders
-      const newCount = response.data.new_orders_count;
-      if (newCount > previousNewCount.current) {
-        playNotificationSound();
-        toast.info(`${newCount - previousNewCount.current} nuovo/i ordine/i!`, {
-          icon: <Bell className="w-5 h-5 text-[#5D1919]" />
+  useEffect(() => {
+    fetchSnapshot();
+
+    // Aggiornamenti push dal server: ricarica solo quando un ordine cambia.
+    // Lo stream si apre con un ticket di breve durata (POST /orders/events/ticket),
+    // che scade dopo un minuto: se la connessione cade non si lascia riprovare
+    // EventSource sullo stesso URL, si chiede un ticket nuovo e si riparte
+    // dall'ultimo evento ricevuto (?since=).
+    let refreshTimeout = null;
+    let reconnectTimeout = null;
+    let eventSource = null;
+    let lastEventId = null;
+    let closed = false;
+    const scheduleRefresh = (event) => {
+      if (event.lastEventId) lastEventId = event.lastEventId;
+      clearTimeout(refreshTimeout);
+      refreshTimeout = setTimeout(fetchSnapshot, 200);
+    };
+    const connect = async () => {
+      try {
+        const response = await axios.post(`${API}/orders/events/ticket`, {}, {
+          headers: { Authorization: `Bearer ${token}` }
         });
-        // Fetch unacknowledged orders to show pop-up
-        fetchUnacknowledgedOrders();
+        if (closed) return;
+        const params = new URLSearchParams({ ticket: response.data.ticket });
+        if (lastEventId) params.set("since", lastEventId);
+        eventSource = new EventSource(`${API}/orders/events?${params}`);
+        eventSource.addEventListener("ready", (event) => { lastEventId = event.lastEventId; });
+        ["order.created", "order.updated", "order.status", "order.acknowledged", "order.deleted", "reset"]
+          .forEach(type => eventSource.addEventListener(type, scheduleRefresh));
+        eventSource.onerror = () => {
+          eventSource.close();
+          reconnectTimeout = setTimeout(connect, 3000);
+        };
+      } catch (error) {
+        if (!closed) reconnectTimeout = setTimeout(connect, 3000);
       }
-      previousNewCount.current = newCount;
-      setNewOrdersCount(newCount);
-    } catch (error) {
-      console.error("Error fetching stats:", error);
-    }
-  }, [token, fetchUnacknowledgedOrders]);
+    };
+    connect();
 
-  useEffect(() => {
-    fetchOrders();
-    fetchNewOrders();
-    fetchStats();
-    fetchUnacknowledgedOrders();
-    
-    // Poll for new orders every 10 seconds
-    const interval = setInterval(() => {
-      fetchOrders();
-      fetchNewOrders();
-      fetchStats();
-      fetchUnacknowledgedOrders();
-    }, 10000);
-    
-    return () => clearInterval(interval);
-  }, [fetchOrders, fetchNewOrders, fetchStats, fetchUnacknowledgedOrders]);
+    // Rete di sicurezza nel caso lo stream cada senza che il browser se ne accorga
+    const interval = setInterval(fetchSnapshot, 60000);
+
+    return () => {
+      closed = true;
+      if (eventSource) eventSource.close();
+      clearTimeout(reconnectTimeout);
+      clearTimeout(refreshTimeout);
+      clearInterval(interval);
+    };
+  }, [fetchSnapshot, token]);
 
   const updateOrderStatus = async (orderId, newStatus) => {
     try {
       await axios.patch(`${API}/orders/${orderId}/status`, { status: newStatus }, { headers });
       toast.success(`Stato aggiornato: ${getStatusLabel(newStatus)}`);
-      fetchOrders();
-      fetchNewOrders();
-      fetchStats();
+      fetchSnapshot();
       // Aggiorna l'ordine selezionato con il nuovo stato
       if (selectedOrder && selectedOrder.id === orderId) {
         setSelectedOrder({ ...selectedOrder, status: newStatus });
@@ -256,7 +258,19 @@ const LaboratorioPage = () => {
     return icons[status] || icons.nuovo;
   };
 
-  const generatePDF = (order) => {
+  // Storico modifiche (modifiche, cambi di stato, prese visione), caricato su richiesta
+  const fetchOrderHistory = async (orderId) => {
+    try {
+      const response = await axios.get(`${API}/orders/${orderId}/history`, { headers });
+      return response.data.events;
+    } catch (error) {
+      console.error("Error fetching order history:", error);
+      return [];
+    }
+  };
+
+  const generatePDF = async (order) => {
+    const modifications = await fetchOrderHistory(order.id);
     const doc = new jsPDF();
     const pageWidth = doc.internal.pageSize.getWidth();
     const logoUrl = "https://customer-assets.emergentagent.com/job_319faa5c-5fca-49f2-9e55-096d5a0f1183/artifacts/hvvg6jn6_518372070_1411016301023513_6348586323466964816_n.jpg";
@@ -454,14 +468,14 @@ const LaboratorioPage = () => {
     }
     
     // Storico modifiche (se presente)
-    if (order.modifications && order.modifications.length > 0) {
+    if (modifications.length > 0) {
       y += 18;
       doc.setFontSize(8);
       doc.setTextColor(100, 100, 100);
       doc.setFont('helvetica', 'bold');
       doc.text('MODIFICHE:', 15, y);
       doc.setFont('helvetica', 'normal');
-      order.modifications.forEach((mod, idx) => {
+      modifications.forEach((mod, idx) => {
         y += 4;
         if (y > 280) {
           doc.addPage();
@@ -642,9 +656,7 @@ const LaboratorioPage = () => {
                 size="icon"
                 data-testid="refresh-btn"
                 onClick={() => {
-                  fetchOrders();
-                  fetchNewOrders();
-                  fetchStats();
+                  fetchSnapshot();
                 }}
                 className="border-[#D6CFC7]"
               >
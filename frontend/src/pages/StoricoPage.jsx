@@ -165,7 +165,19 @@ const StoricoPage = () => {
   };
 
   // Generate PDF function
-  const generatePDF = (order) => {
+  // Storico modifiche (modifiche, cambi di stato, prese visione), caricato su richiesta
+  const fetchOrderHistory = async (orderId) => {
+    try {
+      const response = await axios.get(`${API}/orders/${orderId}/history`, { headers });
+      return response.data.events;
+    } catch (error) {
+      console.error("Error fetching order history:", error);
+      return [];
+    }
+  };
+
+  const generatePDF = async (order) => {
+    const modifications = await fetchOrderHistory(order.id);
     const doc = new jsPDF();
     const pageWidth = doc.internal.pageSize.getWidth();
     const logoUrl = "https://customer-assets.emergentagent.com/job_319faa5c-5fca-49f2-9e55-096d5a0f1183/artifacts/hvvg6jn6_518372070_1411016301023513_6348586323466964816_n.jpg";
@@ -363,14 +375,14 @@ const StoricoPage = () => {
     }
     
     // Storico modifiche (se presente)
-    if (order.modifications && order.modifications.length > 0) {
+    if (modifications.length > 0) {
       y += 18;
       doc.setFontSize(8);
       doc.setTextColor(100, 100, 100);
       doc.setFont('helvetica', 'bold');
       doc.text('MODIFICHE:', 15, y);
       doc.setFont('helvetica', 'normal');
-      order.modifications.forEach((mod, idx) => {
+      modifications.forEach((mod, idx) => {
         y += 4;
         if (y > 280) {
           doc.addPage();
@@ -831,9 +843,11 @@ const StoricoPage = () => {
                               <Button
                                 size="icon"
                                 variant="ghost"
-                                onClick={() => {
+                                onClick={async () => {
                                   setSelectedOrder(order);
                                   setShowDetail(true);
+                                  const modifications = await fetchOrderHistory(order.id);
+                                  setSelectedOrder(current => (current && current.id === order.id ? { ...current, modifications } : current));
                                 }}
                                 data-testid={`view-order-${order.id}`}
                               >
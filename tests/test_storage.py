@@ -0,0 +1,125 @@
+"""Conformance checks shared by the storage backends.
+
+SQLite always runs (temporary file). Mongo runs when MONGO_URL points at a
+reachable server, in a throwaway database dropped afterwards.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from storage import DuplicateError, open_storage  # noqa: E402
+
+BACKENDS = ["sqlite", "mongo"]
+
+
+def mongo_available(url):
+    from pymongo import MongoClient
+    try:
+        MongoClient(url, serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except Exception:
+        return False
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    """Run a scenario coroutine against a fresh storage of the given backend"""
+    backend = request.param
+    if backend == "mongo" and not (os.environ.get("MONGO_URL") and mongo_available(os.environ["MONGO_URL"])):
+        pytest.skip("MONGO_URL not set or not reachable")
+
+    def runner(scenario):
+        async def main():
+            if backend == "sqlite":
+                storage = open_storage("sqlite", sqlite_path=str(tmp_path / "storage.db"))
+                try:
+                    return await scenario(storage)
+                finally:
+                    storage.close()
+            from motor.motor_asyncio import AsyncIOMotorClient
+            client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+            name = f"storage_test_{uuid.uuid4().hex[:8]}"
+            db = client[name]
+            await db.users.create_index("username", unique=True)
+            await db.categories.create_index("name", unique=True)
+            await db.customers.create_index("phone", unique=True)
+            try:
+                return await scenario(open_storage("mongo", db=db))
+            finally:
+                await client.drop_database(name)
+                client.close()
+        return asyncio.run(main())
+
+    return runner
+
+
+def test_users(run):
+    async def scenario(storage):
+        await storage.users.insert({"id": "u1", "username": "banco", "password_hash": "x", "role": "banco"})
+        assert (await storage.users.get_by_username("banco"))["id"] == "u1"
+        assert await storage.users.get_by_username("nessuno") is None
+        with pytest.raises(DuplicateError):
+            await storage.users.insert({"id": "u2", "username": "banco", "password_hash": "y", "role": "banco"})
+    run(scenario)
+
+
+def test_products_and_categories(run):
+    async def scenario(storage):
+        await storage.categories.insert_many([{"id": "c1", "name": "bovino", "label": "Bovino"},
+                                              {"id": "c2", "name": "suino", "label": "Suino"}])
+        await storage.products.insert_many([
+            {"id": "p1", "name": "Bistecca", "category": "bovino", "unit": "kg", "price": None},
+            {"id": "p2", "name": "Salsiccia", "category": "suino", "unit": "kg", "price": 9.5},
+        ])
+        assert [p["id"] for p in await storage.products.list()] == ["p1", "p2"]
+        assert [p["id"] for p in await storage.products.list("suino")] == ["p2"]
+        assert await storage.products.count() == 2 and await storage.products.count("bovino") == 1
+
+        updated = await storage.products.update("p1", {"category": "suino", "price": 20.0})
+        assert updated == {"id": "p1", "name": "Bistecca", "category": "suino", "unit": "kg", "price": 20.0}
+        assert await storage.products.count("suino") == 2
+        assert await storage.products.update("missing", {"price": 1.0}) is None
+        assert await storage.products.delete("p2") is True
+        assert await storage.products.delete("p2") is False
+
+        assert (await storage.categories.get_by_name("suino"))["id"] == "c2"
+        with pytest.raises(DuplicateError):
+            await storage.categories.update("c1", {"name": "suino", "label": "Doppione"})
+        assert (await storage.categories.update("c1", {"name": "manzo", "label": "Manzo"}))["name"] == "manzo"
+        assert await storage.categories.delete("c1") is True
+        assert [c["id"] for c in await storage.categories.list()] == ["c2"]
+        assert await storage.categories.count() == 1
+    run(scenario)
+
+
+def test_customers(run):
+    def customer(customer_id, name, phone, tokens, digits):
+        return {"id": customer_id, "name": name, "phone": phone, "notes": "", "created_at": "2024-01-01",
+                "name_tokens": tokens, "phone_digits": digits}
+
+    async def scenario(storage):
+        await storage.customers.insert(customer("k1", "Mario Rossi", "333 111", ["mario", "rossi"], ["333111"]))
+        await storage.customers.insert(customer("k2", "Maria Bianchi", "347 222", ["bianchi", "maria"],
+                                                ["347222"]))
+        with pytest.raises(DuplicateError):
+            await storage.customers.insert(customer("k3", "Altro", "333 111", ["altro"], ["333111"]))
+        assert await storage.customers.insert_if_absent(customer("k4", "Altro", "333 111", ["altro"],
+                                                                 ["333111"])) is False
+        assert await storage.customers.insert_if_absent(customer("k5", "Luca Verdi", "320 333", ["luca", "verdi"],
+                                                                 ["320333"])) is True
+
+        names = lambda customers: [c["name"] for c in customers]  # noqa: E731
+        assert names(await storage.customers.suggest(["mar"], None, 10)) == ["Maria Bianchi", "Mario Rossi"]
+        assert names(await storage.customers.suggest(["mar", "ros"], None, 10)) == ["Mario Rossi"]
+        assert names(await storage.customers.suggest([], "347", 10)) == ["Maria Bianchi"]
+        assert names(await storage.customers.suggest([], None, 2)) == ["Luca Verdi", "Maria Bianchi"]
+        assert names(await storage.customers.search("ROSS")) == ["Mario Rossi"]
+        assert names(await storage.customers.search("%")) == []
+        assert set((await storage.customers.search(None))[0]) == {"id", "name", "phone", "notes", "created_at"}
+    run(scenario)
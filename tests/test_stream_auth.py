@@ -0,0 +1,76 @@
+"""The lab page opens the order event stream the way the server authenticates it.
+
+EventSource cannot send headers, so the page trades its session token for a
+short-lived ticket and puts that in the URL. These checks read the URLs out of
+LaboratorioPage.jsx and hold them against the routes of server.py.
+"""
+
+import asyncio
+import os
+import re
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAB_PAGE = os.path.join(ROOT, "frontend", "src", "pages", "LaboratorioPage.jsx")
+
+# Importing the app only creates the (lazy) Motor client: no database needed
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "stream_auth_test")
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+import server  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+
+def lab_page():
+    with open(LAB_PAGE, encoding="utf-8") as f:
+        return f.read()
+
+
+def route(path, method):
+    for candidate in server.app.routes:
+        if getattr(candidate, "path", None) == f"/api{path}" and method in candidate.methods:
+            return candidate
+    return None
+
+
+def query_params(api_route):
+    """Query parameter names of a route, its dependencies included"""
+    names = set()
+    pending = [api_route.dependant]
+    while pending:
+        dependant = pending.pop()
+        names.update(param.name for param in dependant.query_params)
+        pending.extend(dependant.dependencies)
+    return names
+
+
+def test_ticket_endpoint_exists():
+    ticket_paths = re.findall(r"axios\.post\(`\$\{API\}(/orders/events/[^`?]*)`", lab_page())
+    assert ticket_paths, "the lab page no longer asks for a stream ticket"
+    for path in ticket_paths:
+        assert route(path, "POST") is not None, path
+
+
+def test_stream_query_params_are_accepted():
+    source = lab_page()
+    stream = re.search(r"new EventSource\(`\$\{API\}(/orders/events)\?", source)
+    assert stream, "the lab page no longer opens the order event stream"
+    sent = set(re.findall(r"URLSearchParams\(\{\s*(\w+):", source)) | set(re.findall(r'params\.set\("(\w+)"', source))
+    assert "ticket" in sent
+    assert "token=" not in source  # the session token never goes in a URL
+    assert sent <= query_params(route(stream.group(1), "GET"))
+
+
+def test_ticket_opens_the_stream_but_not_the_api():
+    user = {"sub": "u1", "username": "laboratorio", "role": "laboratorio"}
+    ticket = server.create_stream_ticket(user)
+    session = server.create_token("u1", "laboratorio", "laboratorio")
+
+    assert asyncio.run(server.get_stream_user(ticket=ticket, credentials=None))["sub"] == "u1"
+    with pytest.raises(HTTPException):
+        server.decode_token(ticket)
+    with pytest.raises(HTTPException):
+        asyncio.run(server.get_stream_user(ticket=session, credentials=None))